@@ -11,17 +11,67 @@
 """
 
 import getopt
+import os
 import sys
 import re
 import csv
+from collections import defaultdict
+from functools import partial
 from datetime import datetime
-from pyparsing import *
-from jinja2 import Environment, FileSystemLoader
+from types import SimpleNamespace
+
+try:
+    import ahocorasick
+except ImportError:
+    # pyahocorasick is optional: without it, names are searched with a regex
+    ahocorasick = None
 
 trollbnf = None
+templateEnv = None
+
+# Region annotations in the input file: "//region name" and "//endregion"
+troll_annotation = re.compile(r'//(end)?region', re.IGNORECASE)
 
+# Regexes of the TROLL scanner, see troll_scan()
+# comments: "/* ... */" and "// ..."
+troll_comment = re.compile(r'/\*.*?\*/|//[^\n]*', re.DOTALL)
+# ADDEQ block: "ADDEQ TOP/BOTTOM, {equations};"
+troll_block = re.compile(r'\bADDEQ\b\s*(?:(?:TOP|BOTTOM)\b\s*)?,(.*?);', re.IGNORECASE | re.DOTALL)
+# region annotations: "--region name" and "--endregion"
+troll_region = re.compile(r'--(end)?region([^\n]*)', re.IGNORECASE)
+# equations: "var_name: left part = right part,"
+# variables: alphanumeric and dots and underlines, first character is not a number
+troll_equation = re.compile(r'([A-Za-z_.][A-Za-z0-9_.]*)\s*:([^=]+)=([^,]+),?')
 
-def troll_BNF():
+
+class Equation(object):
+    """
+    An equation of the model.
+    With __slots__, equations take much less memory than dicts, and their fields are faster to access.
+
+    name: name of the equation, which is the endogenous variable determined by the equation
+    left_side, right_side: the two sides of the equation
+    whole_equation: the whole equation, with html links on the variables
+    variables: list of the endogenous variables in the equation
+    appears_in: list of the equations where the variable of this equation appears
+    legend: legend of the variable of the equation
+    """
+    __slots__ = ('name', 'left_side', 'right_side', 'whole_equation', 'variables', 'appears_in', 'legend')
+
+    def __init__(self, name, left_side, right_side):
+        self.name = name
+        self.left_side = left_side
+        self.right_side = right_side
+        self.whole_equation = ''
+        self.variables = []
+        self.appears_in = []
+        self.legend = []
+
+    def __repr__(self):
+        return 'Equation(' + repr(self.name) + ', ' + repr(self.left_side) + ', ' + repr(self.right_side) + ')'
+
+
+def troll_BNF(packrat=False, cachesize=None):
     """
         This function defines a "grammar" - BNF (https://fr.wikipedia.org/wiki/Forme_de_Backus-Naur)
         to describe the equations in the input TROLL file
@@ -29,21 +79,33 @@ def troll_BNF():
         http://pyparsing.wikispaces.com/
         And this guide:
         http://infohost.nmt.edu/tcc/help/pubs/pyparsing/web/index.html
+        :param packrat: memoize the parse results (packrat parsing). This is slower on the usual TROLL files,
+                        but may help on files where the grammar backtracks a lot.
+        :param cachesize: maximum number of entries of the packrat cache (None for an unbounded cache)
         :return:
     """
     global trollbnf
 
     if not trollbnf:
+        # pyparsing is slow to import, and only needed by the legacy parser
+        from pyparsing import ParserElement, Word, Regex, Literal, CaselessLiteral, CaselessKeyword, \
+            Optional, OneOrMore, Group, Suppress, alphas, alphanums, restOfLine, cppStyleComment
+
+        if packrat:
+            # The cache is unbounded, unless a maximum number of entries is given, to limit the memory used on huge files
+            ParserElement.enablePackrat(cache_size_limit=cachesize)
+
         # We define language elements from bottom to top: first variables, then equations, then blocks...
         # variables: alphanumeric and dots and underlines, first character is not a number
         variable = Word(alphas+"_.", alphanums+"_.")
 
         # equations: "var_name: left part = right part,"
-        nonequal = "".join([c for c in printables if c != "="]) + " \t\n"
-        noncomma = "".join([c for c in printables if c != ","]) + " \t\n"
+        # (Regex elements are matched by the C regex engine, no need to build large sets of characters for Word)
+        nonequal = Regex(r'[^=]+')
+        noncomma = Regex(r'[^,]+')
         equation = variable.setResultsName("name") + Literal(":").suppress() + \
-                   Word(nonequal).setResultsName("left_side") + Literal("=").suppress() + \
-                   Word(noncomma).setResultsName("right_side") + Optional(Literal(",")).suppress()
+                   nonequal.setResultsName("left_side") + Literal("=").suppress() + \
+                   noncomma.setResultsName("right_side") + Optional(Literal(",")).suppress()
 
         # ADDEQ block: "ADDEQ TOP/BOTTOM, {equations};"
         block_addeq_begin = CaselessKeyword("ADDEQ") + \
@@ -62,8 +124,7 @@ def troll_BNF():
 
 
 
-        # Find blocks in the file (suppress anything before the ADDEQ equations block)
-        regions_blocks = OneOrMore(SkipTo(regions).suppress() + regions )
+        # Blocks are found in the file with scanString(), which skips anything before each ADDEQ equations block
 
         #superprintables = "".join([c for c in printables]) + "éèà \t"
         #comment = Literal("//")+Word(superprintables)+LineEnd()
@@ -76,146 +137,239 @@ def troll_BNF():
         comment = cppStyleComment|voidRegion
 
         # Finally, ignore comments in file
-        #trollbnf = regions_blocks.ignore(cppStyleComment)
-        trollbnf = regions_blocks.ignore(comment)
-        #trollbnf = regions_blocks.ignore(comment)
+        #trollbnf = regions.ignore(cppStyleComment)
+        trollbnf = regions.ignore(comment)
+        #trollbnf = regions.ignore(comment)
         #comment.setParseAction(commentHandler)
 
     return trollbnf
 
 
-def makeinternallinks(regions, verbose=False):
+def troll_scan(text):
     """
-    Make links on variables in equations, linking to equations anchors.
-    Also make reverse links (in wich equations a variable appears ?)
-
-    :param regions: list of regions of equations = [name, left_side, right_side, whole_equation]
-    :param verbose:
-    :return: regions: list of regions of equations = [name, left_side, right_side, whole_equation, variables, appears_in]
+        Scan the equations in the input TROLL file with a few compiled regexes,
+        which is much faster than the pyparsing grammar of troll_BNF() (still available with --legacy-parser):
+        ADDEQ blocks "ADDEQ TOP/BOTTOM, {equations};" are split into regions by the "--region" annotations,
+        then into equations "var_name: left part = right part,".
+        :param text: content of the input file, with region annotations formatted as "--region" and "--endregion"
+        :return: list of regions, each one with a name and a list of equations = [name, left_side, right_side]
     """
-    names = []
-    for idx in range(len(regions)):
-        # Lower the case of the equations list
-        # And also add the "variables" and the "appears in" list,
-        regions[idx].equations = [{'name': eq['name'].lower(),
-                      'left_side': eq['left_side'].lower(),
-                      'right_side': eq['right_side'].lower(),
-                      'whole_equation': eq['whole_equation'].lower(),
-                      'variables': [],
-                      'appears_in': [],
-                      } for eq in regions[idx].equations]
-
-        # Extract the equations names
-        names = names + [eq['name'] for eq in regions[idx].equations]
-        # print(names)
+    # Ignore comments in file (region annotations don't begin with "//" anymore)
+    text = troll_comment.sub('', text)
+
+    regions = []
+    for block in troll_block.finditer(text):
+        body = block.group(1)
+        # Equations before a "--region" annotation or after a "--endregion" one are in an unnamed region
+        name = ''
+        start = 0
+        for annotation in list(troll_region.finditer(body)) + [None]:
+            end = annotation.start() if annotation else len(body)
+            equations = [Equation(eq.group(1), eq.group(2).strip(), eq.group(3).strip())
+                         for eq in troll_equation.finditer(body, start, end)]
+            # Void regions are ignored
+            if equations:
+                regions.append(SimpleNamespace(name=name, equations=equations))
+            if annotation:
+                name = '' if annotation.group(1) else [annotation.group(2)]
+                start = annotation.end()
 
-    print("Linking: making html links on variables in equations...")
-    for idx in range(len(regions)):
-        for eq in regions[idx].equations:
-            # Make links in right side of equations
-            for name in names:
-                # Perf improvements: don't perform unuseful regex searches
-                if name in eq['whole_equation'] and name != eq['name']:
-                    # We replace occurences of variable names, but :
-                    # if "cd_ef" and "ab_cd_ef" exist as variables, we musn't replace the part "cd_ef" wich is in "ab_cd_ef"
-                    # So we use a regex with \b wich is a word boundary (eg non alpanumeric and non underscore character, or beginning/end of line).
-                    # If variable if found in equation, we complete the "variables" list, containing the list of the endogenous variables in the eq.
-
-                    regex = re.compile(r'\b(' + name + r')\b')
-                    if regex.search(eq['whole_equation']):
-                        eq['variables'].append(name)
-                        eq['whole_equation'] = regex.sub(r'<a href="#\1">\1</a>', eq['whole_equation'])
-                        if verbose:
-                            print("Making a link on " + name + " in " + eq['whole_equation'])
-
-                if name == eq['name']:
-                    # also create a link, but add a special class
-                    p = re.compile(r'\b(' + name + r')\b')
-                    eq['whole_equation'] = p.sub(r'<a href="#\1" class="main_variable">\1</a>', eq['whole_equation'])
+    return regions
 
-    print("Reverse linking: finding in which equations variables appear...")
-    for idx in range(len(regions)):
-        for eq in regions[idx].equations:
-            for loop_idx in range(len(regions)):
-                for loop_eq in regions[loop_idx].equations:
-                    if eq['name'] != loop_eq['name'] and eq['name'] in loop_eq['variables']:
-                        eq['appears_in'].append(loop_eq['name'])
 
-    return regions
+def makeautomaton(names):
+    """
+    Build a multi-pattern matcher over all the variable names, so that each equation
+    is scanned once for all the names, instead of once per name.
+    It uses an Aho-Corasick automaton (pyahocorasick module) if available,
+    or else a single regex, alternation of all the names.
 
-def replaceparamsbyvalues(regions, paramsfile, verbose=False):
+    :param names: list of variable names
+    :return: a function giving the list of (start, end, name) occurrences of the names in a string
     """
-    Replace parameters of the equation by corresponding values
+    if not names:
+        # An empty automaton can't be built nor iterated, and an empty alternation would match everywhere
+        return lambda text: []
+
+    if ahocorasick is None:
+        # We replace occurences of variable names, but :
+        # if "cd_ef" and "ab_cd_ef" exist as variables, we musn't replace the part "cd_ef" wich is in "ab_cd_ef"
+        # So we use a regex with \b wich is a word boundary (eg non alpanumeric and non underscore character, or beginning/end of line).
+        # Longest names come first in the alternation, so that the longest name is found at a given position.
+        regex = re.compile(r'\b(' + '|'.join(re.escape(name) for name in sorted(set(names), key=len, reverse=True)) + r')\b')
+
+        def findnames(text):
+            # Matched names are new strings: intern them, to share the (interned) names given to the automaton
+            return [(match.start(), match.end(), sys.intern(match.group(1))) for match in regex.finditer(text)]
+
+        return findnames
+
+    automaton = ahocorasick.Automaton()
+    for name in names:
+        automaton.add_word(name, name)
+    automaton.make_automaton()
+    iterautomaton = automaton.iter
+    leftmostlongest = lambda hit: (hit[0], -hit[1])
+
+    def findnames(text):
+        # iter() gives the index of the last character of each match.
+        # Keep the leftmost, then longest, occurrences surrounded by word boundaries, like the regex does,
+        # so that "cd_ef" is not found in "ab_cd_ef" and overlapping names are not linked twice
+        candidates = [(end - len(name) + 1, end + 1, name) for end, name in iterautomaton(text)]
+        candidates.sort(key=leftmostlongest)
+        hits = []
+        last = 0
+        length = len(text)
+        for start, end, name in candidates:
+            # A word boundary, like the \b of a regex, is between a word character (alphanumeric or underscore)
+            # and a non word character: the characters around the name must not be of the same kind as its ends
+            if start >= last \
+                    and (start > 0 and (text[start-1].isalnum() or text[start-1] == '_')) != (name[0].isalnum() or name[0] == '_') \
+                    and (end < length and (text[end].isalnum() or text[end] == '_')) != (name[-1].isalnum() or name[-1] == '_'):
+                hits.append((start, end, name))
+                last = end
+        return hits
+
+    return findnames
+
+
+def readcsv(csvfilename):
+    """
+    Read a csv file of names and values (parameters values or legends)
 
-    :param regions: list of regions of equations = [name, left_side, right_side, whole_equation, variables, appears_in]
-    :param paramsfile: file with parameter names and parameter values
-    :param verbose:
-    :return: equations: list of equations = [name, left_side, right_side, whole_equation, variables, appears_in]
+    :param csvfilename: csv file, with ';' as delimiter
+    :return: dict of values, indexed by the lowercased names
     """
-    params = {}
-    with open(paramsfile, newline='', encoding='iso-8859-1') as csvfile:
-        spamReader = csv.reader(csvfile, delimiter=';')
-        for row in spamReader:
-            #print(row[0], row[1])
-            params[row[0].lower()] = row[1]
-        #print(params)
-    paramnames = list(params.keys())
-
-    print("Replacing parameter names by their values...")
-    for idx in range(len(regions)):
-        for eq in regions[idx].equations:
-            for paramname in paramnames:
-                # Perf improvements: don't perform unuseful regex searches
-                if paramname in eq['whole_equation']:
-                    regex = re.compile(r'\b(' + paramname + r')\b')
-                    if regex.search(eq['whole_equation']):
-                        eq['whole_equation'] = regex.sub(eval('r'+repr(params[paramname])), eq['whole_equation'])
-                        if verbose:
-                            print("Replacing the parameter " + paramname + " in " + eq['whole_equation'])
+    with open(csvfilename, newline='', encoding='iso-8859-1') as csvfile:
+        # Names are stripped and lowercased once here, like the equation names they are compared to
+        # (rows without a name are skipped: an empty name would match everywhere in the regex search of makeautomaton)
+        return {row[0].strip().lower(): row[1] for row in csv.reader(csvfile, delimiter=';') if row[0].strip()}
 
-    return regions
 
-def insertlegends(regions, legendsfile, verbose=False):
+def linkequations(equations, names, params, legends, verbose=False):
+    """
+    Make links on variables in equations, replace parameters by their values and find the legends of the equations.
+    This is the part of processequations() which can run in parallel, on chunks of equations.
+
+    :param equations: list of equations = (name, whole_equation)
+    :param names: list of the names of all the equations
+    :param params: dict of parameter values, indexed by parameter names
+    :param legends: dict of legends, indexed by variable names
+    :param verbose:
+    :return: list of (whole_equation, variables, legend) for each equation
+    """
+    # A single automaton finds both variables and parameters.
+    # If a parameter has the name of a variable, the variable wins.
+    equationnames = frozenset(names)
+    findnames = makeautomaton(names + [paramname for paramname in params if paramname not in equationnames])
+    # The html link of each variable is built once, and shared by all the equations where the variable appears
+    links = {name: '<a href="#' + name + '">' + name + '</a>' for name in equationnames}
+    results = []
+    for eq_name, whole_equation in equations:
+        # Find all the variable and parameter names of the equation in one scan,
+        # then make links and replace parameters in the same pass: the pieces of the new equation
+        # are accumulated in a list and joined once, instead of copying the whole string for each hit.
+        # If variable if found in equation, we complete the "variables" list, containing the list of the endogenous variables in the eq.
+        variables = []
+        # Variables already found in the equation, as a set for constant time lookups (the main variable is not one of them)
+        found = {eq_name}
+        # The main variable also gets a link, but with a special class
+        mainlink = '<a href="#' + eq_name + '" class="main_variable">' + eq_name + '</a>'
+        pieces = []
+        append = pieces.append
+        last = 0
+        for start, end, name in findnames(whole_equation):
+            append(whole_equation[last:start])
+            last = end
+            if name not in equationnames:
+                append(params[name])
+                if verbose:
+                    print("Replacing the parameter " + name + " in " + whole_equation)
+            elif name == eq_name:
+                append(mainlink)
+            else:
+                append(links[name])
+                if name not in found:
+                    found.add(name)
+                    variables.append(name)
+                    if verbose:
+                        print("Making a link on " + name + " in " + whole_equation)
+        append(whole_equation[last:])
+        whole_equation = ''.join(pieces)
+
+        # Legends are given for the variable of the equation, or else for one of the dot-separated parts of its name
+        # (a legend "pib" is also used for the equation "pib.fr", like the word search of the former insertlegends)
+        legend = []
+        for legendname in [eq_name] + eq_name.split('.'):
+            if legendname in legends:
+                legend = legends[legendname]
+                if verbose:
+                    print("Inserting legend " + legendname + " corresponding to " + eq_name)
+                break
+
+        results.append((whole_equation, variables, legend))
+
+    return results
+
+
+def processequations(regions, params, legends, verbose=False, jobs=1):
     """
-    Insert legends for each equation
+    Make links on variables in equations, linking to equations anchors,
+    replace parameters of the equations by corresponding values, and insert legends for each equation.
+    Links and parameters are made in a single scan of each equation.
+    Also make reverse links (in wich equations a variable appears ?)
 
-    :param regions: list of regions of equations = [name, left_side, right_side, whole_equation, variables, appears_in]
-    :param legendsfile: file with variables and their legends
+    :param regions: list of regions of equations = [name, left_side, right_side]
+    :param params: dict of parameter values, indexed by parameter names
+    :param legends: dict of legends, indexed by variable names
     :param verbose:
+    :param jobs: number of processes making the links
     :return: regions: list of regions of equations = [name, left_side, right_side, whole_equation, variables, appears_in, legend]
     """
+    names = []
+    for idx in range(len(regions)):
+        for eq in regions[idx].equations:
+            # Lower the case of the equations, in place.
+            # Names are interned: the same string object is then shared by the names list, the automaton,
+            # the "variables" and "appears in" lists, and dict lookups on it compare pointers first
+            eq.name = sys.intern(eq.name.lower())
+            # Reassemble left and right part into a unique string, because we don't really need
+            # to separate the two parts. Only this string is used from now on, so it is lowered at once,
+            # instead of lowering each part
+            eq.whole_equation = (eq.left_side.strip() + " = " + eq.right_side.strip()).lower()
+
+        # Extract the equations names (extend in place, instead of copying the whole list for each region)
+        names.extend(eq.name for eq in regions[idx].equations)
+        # print(names)
+
+    print("Linking: making html links on variables in equations and replacing parameter names by their values...")
+    equations = [eq for region in regions for eq in region.equations]
+    tasks = [(eq.name, eq.whole_equation) for eq in equations]
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        # Split the equations in one contiguous chunk per process
+        chunksize = -(-len(tasks) // jobs)
+        chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            linkchunk = partial(linkequations, names=names, params=params, legends=legends, verbose=verbose)
+            results = [result for chunk in executor.map(linkchunk, chunks) for result in chunk]
+    else:
+        results = linkequations(tasks, names, params, legends, verbose)
+    for eq, (whole_equation, variables, legend) in zip(equations, results):
+        eq.whole_equation = whole_equation
+        eq.variables = variables
+        eq.legend = legend
 
-    # Add the "legend" field in equations
+    print("Reverse linking: finding in which equations variables appear...")
+    # Invert the "variables" lists in one pass: for each variable, the equations where it appears
+    appears_in = defaultdict(list)
     for idx in range(len(regions)):
-        regions[idx].equations = [{'name': eq['name'],
-                                  'left_side': eq['left_side'],
-                                  'right_side': eq['right_side'],
-                                  'whole_equation': eq['whole_equation'],
-                                  'variables': eq['variables'],
-                                  'appears_in': eq['appears_in'],
-                                  'legend': []
-                                  } for eq in regions[idx].equations]
-
-    legends = {}
-    with open(legendsfile, newline='', encoding='iso-8859-1') as csvfile:
-        spamReader = csv.reader(csvfile, delimiter=';')
-        for row in spamReader:
-            #print(row[0], row[1])
-            legends[row[0].lower()] = row[1]
-        #print(params)
-    legendnames = list(legends.keys())
-
-    print("Inserting legends...")
+        for eq in regions[idx].equations:
+            for variable in eq.variables:
+                appears_in[variable].append(eq.name)
     for idx in range(len(regions)):
         for eq in regions[idx].equations:
-            for legendname in legendnames:
-                # Perf improvements: don't perform unuseful regex searches
-                if legendname in eq['name']:
-                    regex = re.compile(r'\b(' + legendname + r')\b')
-                    if regex.search(eq['name']):
-                        eq['legend'] = legends[legendname]
-                        if verbose:
-                            print("Inserting legend " + legendname + " corresponding to " + eq['name'])
+            eq.appears_in = appears_in.get(eq.name, [])
 
     return regions
 
@@ -228,32 +382,45 @@ def generatehtml(regions, template, output):
     :param output: the html file.
     :return:
     """
+    global templateEnv
+
     print("Generating html output...")
 
-    templateLoader = FileSystemLoader(searchpath="./")
-    templateEnv = Environment(loader=templateLoader)
+    if not templateEnv:
+        # jinja2 is imported here, so that the help and the argument errors don't wait for it
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+        # The environment is created once and reused by the next calls, with its cache of loaded templates:
+        # no limit on this cache, and no check of the template files for changes on each use.
+        # The compiled template is also cached in the temporary directory, so that it is not compiled again on the next runs
+        templateLoader = FileSystemLoader(searchpath="./")
+        templateEnv = Environment(loader=templateLoader, auto_reload=False, cache_size=-1,
+                                  bytecode_cache=FileSystemBytecodeCache())
     tmpl = templateEnv.get_template(template)
 
-    # Render template and write it to output file
+    # Render template and write it to output file, piece by piece, without building the whole html in memory
     with open(output, "w", encoding='utf8') as output_file:
-        output = tmpl.render(
+        tmpl.stream(
             regions=regions,
             date=datetime.now().strftime('%d/%m/%Y - %Hh%M')
-        )
-        output_file.write(output)
+        ).dump(output_file)
 
 
 def usage():
     print("""
     Creates a html documentation for a model described in a TROLL input file.
     Usage :
-        python modeldoc.py -i <troll_input_file.inp> -p <param_file.csv> -l <legend_file.csv> -o <documentation_file.html> [-v]
+        python modeldoc.py -i <troll_input_file.inp> -p <param_file.csv> -l <legend_file.csv> -o <documentation_file.html> [-v] [-j <jobs>] [--legacy-parser [--packrat]]
         
         -i : troll input file (mandatory)
         -p : csv input file (mandatory)
         -l : csv legend file (mandatory)
         -o : html output file (mandatory)
         -v : verbose, prints debug information   
+        -j : number of processes making the links in equations (default: 1, 0 for one per CPU)
+        --legacy-parser : parse the input file with the pyparsing grammar instead of the regex scanner
+        --packrat : with --legacy-parser, enable the packrat parsing of pyparsing
+                    (the TROLLDOC_PACKRAT_CACHE environment variable bounds the number of cached results)
     """)
 
 
@@ -261,7 +428,7 @@ def main():
 
     # Get and check program arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hi:p:l:o:v", ["help", "input=", "paramfile=", "legendfile=", "output=", "verbose"])
+        opts, args = getopt.getopt(sys.argv[1:], "hi:p:l:o:vj:", ["help", "input=", "paramfile=", "legendfile=", "output=", "verbose", "jobs=", "legacy-parser", "packrat"])
     except getopt.GetoptError as err:
         # print help information and exit:
         print(err)  # will print something like "option -a not recognized"
@@ -272,6 +439,9 @@ def main():
     legendfile = None
     output = None
     verbose = False
+    legacyparser = False
+    packrat = False
+    jobs = 1
     for o, a in opts:
         if o in ("-v", "--verbose"):
             verbose = True
@@ -286,79 +456,103 @@ def main():
             legendfile = a
         elif o in ("-o", "--output"):
             output = a
+        elif o in ("-j", "--jobs"):
+            try:
+                jobs = int(a)
+                if jobs < 0:
+                    raise ValueError
+            except ValueError:
+                print("Invalid number of jobs: " + a)
+                usage()
+                sys.exit(2)
+            if jobs == 0:
+                jobs = os.cpu_count() or 1
+        elif o == "--legacy-parser":
+            legacyparser = True
+        elif o == "--packrat":
+            packrat = True
         else:
             assert False, "unhandled option"
     if not input or not paramfile or not legendfile or not output:
         print("Missing argument")
         usage()
         sys.exit(2)
+    cachesize = None
+    if packrat and os.environ.get('TROLLDOC_PACKRAT_CACHE'):
+        # A negative size makes pyparsing loop forever, so only a non-negative number of entries is accepted
+        try:
+            cachesize = int(os.environ['TROLLDOC_PACKRAT_CACHE'])
+            if cachesize < 0:
+                raise ValueError
+        except ValueError:
+            print("Invalid TROLLDOC_PACKRAT_CACHE: " + os.environ['TROLLDOC_PACKRAT_CACHE'])
+            usage()
+            sys.exit(2)
 
     # Parse input file for equations
-    bnf = troll_BNF()
     regions = None
-    try:
-        print("Parsing input file for equations: " + input + " ...")
-        with open(input, "r", encoding='iso-8859-1') as input_file:
-            # Formatting text by replacing region annotations "//region" and "//endregion" by "--region" and "--endregion"
-            # for avoiding to suppress them with other comments
-            input_text = input_file.read()
-            regexRegion = re.compile(r'//region', re.IGNORECASE)
-            regexEndRegion = re.compile(r'//endregion', re.IGNORECASE)
-            formatted_text = regexRegion.sub(r'--region', input_text)
-            formatted_text = regexEndRegion.sub(r'--endregion', formatted_text)
-
-        with open('formatted_' + input, "w", encoding='iso-8859-1') as formatted_file:
-            formatted_file.write(formatted_text)
-
-        with open('formatted_' + input, "r", encoding='iso-8859-1') as formatted_file:
-            regions = bnf.parseFile(formatted_file)
-            if verbose:
-                for line in regions:
-                    print(line.name)
-                    print(line.equations)
-
-        # If parsing went fine, results contains a list of Dict indexed
-        # by: variable, left_side, right_side
-        nequations = 0
-        if verbose:
-            print('---')
-            for region in regions:
-                for equation in region.equations:
-                    nequations = nequations + 1
-                    # print(equation)
-                    print("Equation: " + equation['name'])
-                    print("Left side of equation: " + equation['left_side'])
-                    print("Right side of equation: " + equation['right_side'])
-                    print('---')
-            print(str(nequations) + " equations found.")
-    except ParseException as x:
+    print("Parsing input file for equations: " + input + " ...")
+    with open(input, "r", encoding='iso-8859-1') as input_file:
+        # Formatting text by replacing region annotations "//region" and "//endregion" by "--region" and "--endregion"
+        # for avoiding to suppress them with other comments
+        # (a single regex for both annotations, so that the text is scanned and copied only once)
+        input_text = input_file.read()
+        formatted_text = troll_annotation.sub(lambda m: '--endregion' if m.group(1) else '--region', input_text)
+
+    if legacyparser:
+        bnf = troll_BNF(packrat, cachesize)
+        # Scan the ADDEQ blocks one by one, and flatten each one into plain regions and equations,
+        # so that the tree of pyparsing results is not kept in memory
+        regions = []
+        for tokens, start, end in bnf.scanString(formatted_text):
+            for region in tokens:
+                regions.append(SimpleNamespace(
+                    name=region.name.asList() if region.name else '',
+                    equations=[Equation(eq['name'], eq['left_side'], eq['right_side'])
+                               for eq in region.equations]))
+    else:
+        regions = troll_scan(formatted_text)
+
+    if not regions:
         print("No equation found in file: " + input)
         sys.exit()
 
-    # Reassemble left and right part into a unique string, because we don't really need
-    # to separate the two parts
-    for region in regions:
-        for equation in region.equations:
-            equation['whole_equation'] = equation['left_side'].strip() + " = " + equation['right_side'].strip()
-
-    # Complete results with internal links from variables to equations
-    regions = makeinternallinks(regions, verbose)
-
-    # Replace parameters by their values
-    regions = replaceparamsbyvalues(regions, paramfile, verbose)
-
-    # Insert legends for each equation
-    regions = insertlegends(regions, legendfile, verbose)
+    # If parsing went fine, results contains a list of Dict indexed
+    # by: variable, left_side, right_side
+    nequations = 0
+    if verbose:
+        for line in regions:
+            print(line.name)
+            print(line.equations)
+        print('---')
+        for region in regions:
+            for equation in region.equations:
+                nequations = nequations + 1
+                # print(equation)
+                print("Equation: " + equation.name)
+                print("Left side of equation: " + equation.left_side)
+                print("Right side of equation: " + equation.right_side)
+                print('---')
+        print(str(nequations) + " equations found.")
+
+    # Complete results with internal links from variables to equations,
+    # replace parameters by their values and insert legends for each equation
+    params = readcsv(paramfile)
+    legends = readcsv(legendfile)
+    regions = processequations(regions, params, legends, verbose, jobs)
 
     # Generate the html file
     generatehtml(regions, 'docindex.html.jinja', output)
 
-    print('Printing region names...')
-    for line in regions:
-        if len(str(line.name))>0:
-            print(str(line.name)+'\n')
-            #print(line.equations)
+    if verbose:
+        print('Printing region names...')
+        for line in regions:
+            if len(str(line.name))>0:
+                print(str(line.name)+'\n')
+                #print(line.equations)
 
     print("Done. Output in file " + output + ".")
 
-main()
+# The guard is needed by the processes of the "-j" option, which import this module
+if __name__ == "__main__":
+    main()